@@ -1,73 +1,88 @@
 import os
-from flask import Flask, request, jsonify
 import asyncio
 import uuid
 import logging
 import sys
-from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
+from typing import Optional
 import pymongo
-from pymongo import MongoClient
+from pymongo import UpdateOne
 from bson.binary import Binary, UUID_SUBTYPE
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
 from shapely.geometry import Polygon
-import osmnx as ox
 import shutil
+import uvicorn
 from utils.config import Config
+from utils.db import jobs_collection, routes_collection, ensure_indexes
+from utils.logging_setup import setup_logging
 from utils.route_planner_class import RoutePlanner
 import os
 
-# Simplify the logging setup
+setup_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
-file_handler = logging.FileHandler(Config.LOG_FILE)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
 
-logger.info("Flask application started, logging initialized!")
+logger.info("FastAPI application started, logging initialized!")
 
-# Ensure cache directory exists
-os.makedirs(Config.CUSTOM_CACHE_DIR, exist_ok=True)
-ox.settings.cache_folder = Config.CUSTOM_CACHE_DIR
-ox.settings.use_cache = False
-ox.settings.cache_only_mode = False
+# Maximum number of route documents sent in a single insert_many call
+ROUTES_INSERT_BATCH_SIZE = 1000
 
-# MongoDB Connection
+# Job status writes are sent every STATUS_FLUSH_INTERVAL seconds or once STATUS_BATCH_SIZE are queued
+STATUS_FLUSH_INTERVAL = 1.0
+STATUS_BATCH_SIZE = 32
 
-logger.info("Attempting to connect to MongoDB...")
-client = MongoClient(Config.MONGO_URI)
-db = client[Config.MONGO_DB]
-jobs_collection = db['job_status']
-routes_collection = db['result_routes']
-#routes_collection.create_index({"polyline": "2dsphere"})
-logger.info("Connected to MongoDB successfully.")
+@asynccontextmanager
+async def lifespan(app):
+    try:
+        await ensure_indexes()
+        logger.info("MongoDB indexes ensured.")
+    except Exception as e:
+        logger.error("Failed to create MongoDB indexes: %s", str(e))
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# Strong references to running jobs so they are not garbage collected mid-flight
+running_jobs = set()
+
+
+class StartJobRequest(BaseModel):
+    """Request body of /start_job; required fields are validated in the handler."""
+    start: Optional[dict] = None
+    end: Optional[dict] = None
+    radius: Optional[float] = None
+    polygon: Optional[list[dict]] = None
+    middle_points: list[dict] = []
+    network_type: Optional[str] = None
+    max_routes: Optional[int] = Field(None, gt=0, le=Config.MAX_ROUTES_LIMIT)
 
-executor = ThreadPoolExecutor(max_workers=4)
-app = Flask(__name__)
 
 # Keep only important log messages
-@app.route("/start_job", methods=["POST"])
-def start_job():
+@app.post("/start_job")
+async def start_job(payload: StartJobRequest):
     try:
-        data = request.get_json()
-        
+        data = payload.model_dump(exclude_none=True)
+
         # Validate start coordinates
         if "start" not in data:
-            return jsonify({"error": "Missing required field: start"}), 400
-            
+            return JSONResponse({"error": "Missing required field: start"}, status_code=400)
+
         # Validate that either radius or polygon is provided
         if "radius" not in data and "polygon" not in data:
-            return jsonify({"error": "Either radius or polygon must be provided"}), 400
+            return JSONResponse({"error": "Either radius or polygon must be provided"}, status_code=400)
 
         if "network_type" not in data:
-            return jsonify({"error": "Missing required field: network_type"}), 400
+            return JSONResponse({"error": "Missing required field: network_type"}, status_code=400)
 
         job_id1 = uuid.uuid4()
         job_id = str(job_id1)
+        job_bin = Binary(job_id1.bytes, UUID_SUBTYPE)
         current_time =  datetime.now(timezone.utc)
 
         job_document = {
-            "id": Binary(job_id1.bytes, UUID_SUBTYPE),
+            "id": job_bin,
             "returnCode": 1,
             "model_id": 5,
             "timeRunning": 0,
@@ -77,55 +92,77 @@ def start_job():
             "timeEnd": None
         }
 
-        jobs_collection.insert_one(job_document)
+        await jobs_collection.insert_one(job_document)
         logger.info("Started job %s", job_id)
 
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_in_executor(executor, schedule_job, job_id, data)
+        network_type = data.get("network_type", Config.TYPE_OF_MAP) # Default to config if not provided
+        task = asyncio.create_task(process_job(job_id, job_bin, data, network_type))
+        running_jobs.add(task)
+        task.add_done_callback(running_jobs.discard)
 
-        return jsonify({"job_id": job_id}), 202
+        return JSONResponse({"job_id": job_id}, status_code=202)
     except Exception as e:
         logger.error("Failed to start job: %s", str(e))
-        return jsonify({"error": "Failed to start job"}), 400
-
-
-def schedule_job(job_id, data):
+        return JSONResponse({"error": "Failed to start job"}, status_code=400)
+
+
+async def drain_status_updates(status_updates):
+    """
+    Write queued job status operations with bulk_write until a None sentinel is received.
+    """
+    loop = asyncio.get_running_loop()
+    finished = False
+    while not finished:
+        ops = []
+        deadline = loop.time() + STATUS_FLUSH_INTERVAL
+        while len(ops) < STATUS_BATCH_SIZE:
+            try:
+                op = await asyncio.wait_for(status_updates.get(), timeout=max(deadline - loop.time(), 0))
+            except asyncio.TimeoutError:
+                break
+            if op is None:
+                finished = True
+                break
+            ops.append(op)
+
+        if ops:
+            try:
+                # Ordered so successive progress updates of the job are applied in sequence
+                await jobs_collection.bulk_write(ops, ordered=True)
+            except Exception as e:
+                logger.error("Failed to write job status updates: %s", str(e))
+
+
+async def process_job(job_id, job_bin, data, network_type):
     logger.info("Processing job: %s", job_id)
-    try:
-        network_type = data.get("network_type", Config.TYPE_OF_MAP) # Default to config if not provided
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(process_job(job_id, data, network_type))
-        logger.info("Job %s completed successfully", job_id)
-        jobs_collection.update_one({"id": Binary(uuid.UUID(job_id).bytes, UUID_SUBTYPE)}, {"$set": {"returnCode": 0, "timeEnd":  datetime.now(timezone.utc)}})
-    except Exception as e:
-        logger.error("Error processing job %s: %s", job_id, str(e))
-        jobs_collection.update_one({"id": Binary(uuid.UUID(job_id).bytes, UUID_SUBTYPE)}, {"$set": {"returnCode": -1, "error": str(e), "timeEnd":  datetime.now(timezone.utc)}})
-
-async def process_job(job_id, data, network_type):
+    job_filter = {"id": job_bin}
+    status_updates = asyncio.Queue()
+    status_writer = asyncio.create_task(drain_status_updates(status_updates))
     try:
         start = data.get("start")
         radius = data.get("radius")
         polygon_coords = data.get("polygon")
         end = data.get("end")
         middle_points = data.get("middle_points", [])
-        
+
         if not start:
             raise ValueError("Start location is required")
-        
+
         start_location = (start["latitude"], start["longitude"])
         end_location = (end["latitude"], end["longitude"]) if end else None
 
-        logger.info("Job %s: start location: %s, end location: %s, radius: %s, polygon: %s, middle points: %s", 
+        logger.info("Job %s: start location: %s, end location: %s, radius: %s, polygon: %s, middle points: %s",
                    job_id, start_location, end_location, radius, polygon_coords, middle_points)
 
+        loop = asyncio.get_running_loop()
+
         def mongo_progress_tracker(progress_data):
-            jobs_collection.update_one(
-                {"id": Binary(uuid.UUID(job_id).bytes, UUID_SUBTYPE)}, 
-                {"$set": progress_data}
+            # Called from the worker thread running the planner: queue the write on the event loop
+            loop.call_soon_threadsafe(
+                status_updates.put_nowait,
+                UpdateOne(job_filter, {"$set": progress_data})
             )
-        
+
         # Fixed: Properly pass network_type as a keyword argument
         planner = RoutePlanner(
             start_location=start_location,
@@ -133,39 +170,55 @@ async def process_job(job_id, data, network_type):
             end_location=end_location,
             end_name="End",
             radius_meters=radius,
-            network_type=network_type
+            network_type=network_type,
+            max_routes=data.get("max_routes", Config.MAX_ROUTES)
         )
-        planner.set_progress_tracker(Binary(uuid.UUID(job_id).bytes, UUID_SUBTYPE), mongo_progress_tracker)
-        
+        planner.set_progress_tracker(job_bin, mongo_progress_tracker)
+
+        # Graph fetching and route enumeration are blocking, keep them off the event loop
         if radius:
             if end_location:
-                await planner.compute_routes_start_end_radius()
+                await asyncio.to_thread(planner.compute_routes_start_end_radius)
             else:
-                await planner.compute_routes_start_radius()
+                await asyncio.to_thread(planner.compute_routes_start_radius)
         elif polygon_coords:
             polygon_points = [(pt['longitude'], pt['latitude']) for pt in polygon_coords]
             polygon = Polygon(polygon_points)
             if end_location:
-                await planner.compute_routes_start_end_polygon(polygon)
+                await asyncio.to_thread(planner.compute_routes_start_end_polygon, polygon)
             else:
-                await planner.compute_routes_start_polygon(polygon)
+                await asyncio.to_thread(planner.compute_routes_start_polygon, polygon)
         else:
             raise ValueError("Either radius or polygon coordinates must be provided")
-        
-        routes = planner.filter_routes_by_point(middle_points) if middle_points else planner.get_route_polylines()
+
+        if middle_points:
+            routes = await asyncio.to_thread(planner.filter_routes_by_point, middle_points)
+        else:
+            routes = await asyncio.to_thread(planner.get_route_polylines)
         logger.info("Job %s: processed %d routes", job_id, len(routes))
-        
-        for idx, route in enumerate(routes):
-            routes_collection.insert_one({
-                "job_id": Binary(uuid.UUID(job_id).bytes, UUID_SUBTYPE),
+
+        docs = [
+            {
+                "job_id": job_bin,
                 "route_id": idx + 1,
                 "polyline": {"type": "LineString", "coordinates": route["polyline"]}
-            })
-    
+            }
+            for idx, route in enumerate(routes)
+        ]
+        # Insert in chunks to stay well below the 16 MB batch limit
+        for i in range(0, len(docs), ROUTES_INSERT_BATCH_SIZE):
+            await routes_collection.insert_many(docs[i:i + ROUTES_INSERT_BATCH_SIZE], ordered=False)
+
+        logger.info("Job %s completed successfully", job_id)
+        status_updates.put_nowait(UpdateOne(job_filter, {"$set": {"returnCode": 0, "timeEnd":  datetime.now(timezone.utc)}}))
     except Exception as e:
-        logger.error("Error in job %s: %s", job_id, str(e))
-        raise
+        logger.error("Error processing job %s: %s", job_id, str(e))
+        status_updates.put_nowait(UpdateOne(job_filter, {"$set": {"returnCode": -1, "error": str(e), "timeEnd":  datetime.now(timezone.utc)}}))
+    finally:
+        # The terminal status goes out in the same bulk_write as any pending progress
+        status_updates.put_nowait(None)
+        await status_writer
 
 if __name__ == "__main__":
-    logger.info("Starting Flask application on %s:%s", Config.FLASK_HOST, Config.FLASK_PORT)
-    app.run(debug=Config.FLASK_DEBUG, host=Config.FLASK_HOST, port=Config.FLASK_PORT)
+    logger.info("Starting FastAPI application on %s:%s", Config.APP_HOST, Config.APP_PORT)
+    uvicorn.run("app:app", host=Config.APP_HOST, port=Config.APP_PORT, reload=Config.APP_DEBUG)
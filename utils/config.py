@@ -17,18 +17,25 @@ class Config:
     SIMPLIFY = os.getenv("SIMPLIFY")
     TRUNCATE_EDGE = os.getenv("TRUNCATE_EDGE")
     RETAIN = os.getenv("RETAIN")
+    MAX_PATH_LENGTH = int(os.getenv("MAX_PATH_LENGTH", 20))  # Max number of edges per enumerated route
+    MAX_ROUTES = int(os.getenv("MAX_ROUTES", 50))  # Max number of routes returned between start and end
+    MAX_ROUTES_LIMIT = int(os.getenv("MAX_ROUTES_LIMIT", 500))  # Upper bound a request may ask for
     # Logging Settings
     LOG_DIR = os.getenv("LOG_DIR", "/var/www/route_planner/logs")
     LOG_FILE = os.path.join(LOG_DIR, os.getenv("LOG_FILE", "app.log"))
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    PLANNER_LOG_LEVEL = os.getenv("PLANNER_LOG_LEVEL", LOG_LEVEL).upper()  # e.g. WARNING in production
     
     # Cache Settings
     CUSTOM_CACHE_DIR = os.getenv("CUSTOM_CACHE_DIR", "/var/www/route_planner/custom_cache")
+    GRAPH_CACHE_DIR = os.path.join(CUSTOM_CACHE_DIR, "graphs")  # Pickled road network graphs
     
-    # Flask Settings
-    FLASK_HOST = os.getenv("FLASK_HOST", "127.0.0.1")
-    FLASK_PORT = int(os.getenv("FLASK_PORT", 4000))
-    FLASK_DEBUG = os.getenv("FLASK_DEBUG", "False").lower() in ("true", "1")
+    # Server Settings (APP_* takes precedence, FLASK_* is still honoured for existing deployments)
+    APP_HOST = os.getenv("APP_HOST", os.getenv("FLASK_HOST", "127.0.0.1"))
+    APP_PORT = int(os.getenv("APP_PORT", os.getenv("FLASK_PORT", 4000)))
+    APP_DEBUG = os.getenv("APP_DEBUG", os.getenv("FLASK_DEBUG", "False")).lower() in ("true", "1")
 
 # Ensure directories exist
 os.makedirs(Config.LOG_DIR, exist_ok=True)
 os.makedirs(Config.CUSTOM_CACHE_DIR, exist_ok=True)
+os.makedirs(Config.GRAPH_CACHE_DIR, exist_ok=True)
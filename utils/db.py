@@ -0,0 +1,17 @@
+import pymongo
+from motor.motor_asyncio import AsyncIOMotorClient
+from utils.config import Config
+
+# MongoDB Connection: one pooled client shared by the whole process
+client = AsyncIOMotorClient(Config.MONGO_URI, maxPoolSize=50, minPoolSize=5)
+db = client[Config.MONGO_DB]
+jobs_collection = db['job_status']
+routes_collection = db['result_routes']
+#routes_collection.create_index({"polyline": "2dsphere"})
+
+async def ensure_indexes():
+    """
+    Create the indexes used by the job status updates and route lookups (no-op if they exist).
+    """
+    await jobs_collection.create_index([("id", pymongo.ASCENDING)], unique=True)
+    await routes_collection.create_index([("job_id", pymongo.ASCENDING), ("route_id", pymongo.ASCENDING)], unique=True)
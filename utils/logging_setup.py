@@ -0,0 +1,36 @@
+import sys
+import atexit
+import queue
+import logging
+from logging.handlers import QueueHandler, QueueListener
+from utils.config import Config
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(name)s - %(message)s'
+
+def setup_logging(level=Config.LOG_LEVEL):
+    """
+    Route all log records through a queue drained by a background listener.
+
+    Callers only enqueue records; the file and console writes happen on the
+    listener thread. Idempotent: under the reloader or on re-import the
+    handlers are only added once, so every record is written a single time.
+    """
+    root_logger = logging.getLogger()
+    if root_logger.handlers:
+        return
+
+    formatter = logging.Formatter(LOG_FORMAT)
+
+    file_handler = logging.FileHandler(Config.LOG_FILE)
+    file_handler.setFormatter(formatter)
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on shutdown
+
+    root_logger.addHandler(QueueHandler(log_queue))
+    root_logger.setLevel(level)
@@ -1,55 +1,72 @@
 import sys
 import osmnx as ox
 import networkx as nx
+import numpy as np
 import time
-import asyncio
-from geopy.distance import geodesic
+from itertools import islice
 import math
 import folium
 import os
+import hashlib
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
 from folium import Circle, PolyLine, Polygon as FoliumPolygon
 import shutil
 import logging
+from sklearn.neighbors import BallTree
 from utils.config import Config
 
-# Setup logging
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-
-file_handler = logging.FileHandler(Config.LOG_FILE)
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-console_handler.setFormatter(file_formatter)
-console_handler.flush = sys.stdout.flush
-logger.addHandler(console_handler) 
-
-logger.info("Flask application started, logging initialized!")
-
-# Ensure cache directory exists
-os.makedirs(Config.CUSTOM_CACHE_DIR, exist_ok=True)
-ox.settings.cache_folder = Config.CUSTOM_CACHE_DIR
-ox.settings.use_cache = False
-ox.settings.cache_only_mode = False
-
-sys.stdout.flush()
+logger.setLevel(Config.PLANNER_LOG_LEVEL)
+
+# Configure OSMnx once per process, even if this module is imported again
+if not getattr(ox.settings, "_configured", False):
+    ox.settings.cache_folder = Config.CUSTOM_CACHE_DIR
+    ox.settings.use_cache = True
+    ox.settings.cache_only_mode = False
+    ox.settings._configured = True
+
+def graph_cache_path(*key_parts):
+    """
+    Return the pickle path of a cached graph for the given query parameters.
+    """
+    key = hashlib.sha1(repr(key_parts).encode()).hexdigest()
+    return os.path.join(Config.GRAPH_CACHE_DIR, key + ".pkl")
+
+# Minimum delay in seconds between two progress writes with the same percentage
+PROGRESS_MIN_INTERVAL = 0.2
+
+# Nearest-node lookups shared by all jobs, keyed by (graph cache path, lat, lon)
+NEAREST_NODE_CACHE_SIZE = 4096
+_nearest_node_cache = OrderedDict()
+_nearest_node_lock = threading.Lock()
 
 class RoutePlanner:
-    def __init__(self, start_location, start_name, network_type, end_location=None, end_name=None, radius_meters=None):
+    def __init__(self, start_location, start_name, network_type, end_location=None, end_name=None, radius_meters=None,
+                 max_routes=Config.MAX_ROUTES):
         self.start_location = start_location
         self.start_name = start_name
         self.end_location = end_location
         self.end_name = end_name
         self.radius_km = radius_meters / 1000 if radius_meters else None
         self.graph = None
+        self.node_ids = np.empty(0, dtype=np.int64)
+        self.node_idx = {}
+        self.node_y = np.empty(0)
+        self.node_x = np.empty(0)
+        self.edge_coords = {}
+        self._node_tree = None
+        self.graph_key = None
         self.unique_routes = []
         self.job_id = None
         self.progress_tracker = None
         self.network_type = network_type
+        self.max_routes = max_routes
+        self._last_progress_ts = 0.0
+        self._last_progress_pct = -1
+        self._pending_progress = None
 
     def set_progress_tracker(self, job_id, progress_tracker):
         """
@@ -65,7 +82,18 @@ class RoutePlanner:
         if not self.job_id or not self.progress_tracker:
             return
 
-        elapsed_time = time.time() - start_time
+        # Throttle writes: skipped updates are kept for flush_progress
+        now = time.time()
+        pct = completed_routes * 100 // total_routes if total_routes > 0 else 100
+        if now - self._last_progress_ts <= PROGRESS_MIN_INTERVAL and pct == self._last_progress_pct:
+            self._pending_progress = (completed_routes, total_routes, start_time)
+            return
+
+        self._last_progress_ts = now
+        self._last_progress_pct = pct
+        self._pending_progress = None
+
+        elapsed_time = now - start_time
         avg_time_per_route = elapsed_time / completed_routes if completed_routes > 0 else 0
         remaining_routes = total_routes - completed_routes
         estimated_time_remaining = avg_time_per_route * remaining_routes
@@ -79,6 +107,14 @@ class RoutePlanner:
         # Call the progress tracker function
         self.progress_tracker(progress_data)
 
+    def flush_progress(self):
+        """
+        Send the last progress update held back by the throttle, if any.
+        """
+        if self._pending_progress:
+            self._last_progress_ts = 0.0
+            self.update_progress(*self._pending_progress)
+
     def fetch_graph_radius(self):
         if not self.radius_km:
             logger.error("Radius is required to fetch the graph.")
@@ -86,10 +122,20 @@ class RoutePlanner:
 
         logger.info("Fetching graph for location %s with radius %.2f km", self.start_location, self.radius_km)
 
+        cache_path = graph_cache_path(
+            round(self.start_location[0], 4),
+            round(self.start_location[1], 4),
+            round(self.radius_km, 3),
+            self.network_type.lower()
+        )
+        self.graph_key = cache_path
+        if self.load_cached_graph(cache_path):
+            return
+
         logger.info("Network type: %s", self.network_type)
-        logger.info(f"Truncate by edge: {TRUNCATE_EDGE}")
-        logger.info(f"Simplify: {SIMPLIFY}")
-        logger.info(f"Retain: {RETAIN}")
+        logger.info(f"Truncate by edge: {Config.TRUNCATE_EDGE}")
+        logger.info(f"Simplify: {Config.SIMPLIFY}")
+        logger.info(f"Retain: {Config.RETAIN}")
         try:
             graph = ox.graph_from_point(
                 self.start_location,
@@ -103,6 +149,8 @@ class RoutePlanner:
                 raise ValueError("Graph fetch returned None.")
 
             self.graph = graph  # Explicitly assign graph here
+            self.build_graph_lookups()
+            self.store_cached_graph(cache_path)
             logger.info("Graph fetched: %d nodes, %d edges", len(self.graph.nodes), len(self.graph.edges))
         except Exception as e:
             logger.error("Error fetching graph: %s", str(e), exc_info=True)
@@ -113,6 +161,11 @@ class RoutePlanner:
         """
         Fetch a road network graph for the provided polygon.
         """
+        cache_path = graph_cache_path(polygon.wkt, self.network_type.lower())
+        self.graph_key = cache_path
+        if self.load_cached_graph(cache_path):
+            return
+
         logger.info("Network type: %s", self.network_type)
         logger.info(f"Truncate by edge: {Config.TRUNCATE_EDGE}")
         logger.info(f"Simplify: {Config.SIMPLIFY}")
@@ -130,45 +183,181 @@ class RoutePlanner:
                 logger.error("Failed to fetch graph for polygon")
                 raise ValueError("Failed to fetch graph. Please verify the polygon.")
 
+            self.build_graph_lookups()
+            self.store_cached_graph(cache_path)
         except Exception as e:
             logger.error("Error fetching graph: %s", str(e))
             self.graph = None
 
-    async def compute_routes_start_radius(self):
+    def load_cached_graph(self, cache_path):
+        """
+        Load a previously fetched graph from disk. Return True on a cache hit.
+        """
+        if not os.path.exists(cache_path):
+            return False
+
+        try:
+            with open(cache_path, "rb") as f:
+                self.graph = pickle.load(f)
+        except Exception as e:
+            logger.warning("Ignoring unreadable graph cache %s: %s", cache_path, str(e))
+            self.graph = None
+            return False
+
+        self.build_graph_lookups()
+        logger.info("Graph loaded from cache %s: %d nodes, %d edges", cache_path, len(self.graph.nodes), len(self.graph.edges))
+        return True
+
+    def store_cached_graph(self, cache_path):
+        """
+        Persist the current graph so identical queries skip the Overpass download.
+        """
+        tmp_path = None
+        try:
+            # Write to a temporary file first so concurrent jobs never read a partial pickle
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(cache_path), suffix=".tmp", delete=False) as f:
+                tmp_path = f.name
+                pickle.dump(self.graph, f, protocol=5)
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            logger.warning("Could not write graph cache %s: %s", cache_path, str(e))
+            if tmp_path and os.path.exists(tmp_path):
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+
+    def build_graph_lookups(self):
+        """
+        Precompute node coordinate arrays and the (lat, lon) points of every edge.
+        """
+        nodes = list(self.graph.nodes)
+        self.node_ids = np.fromiter(nodes, dtype=np.int64, count=len(nodes))
+        self.node_idx = {node: i for i, node in enumerate(nodes)}
+        self.node_y = np.fromiter((self.graph.nodes[node]['y'] for node in nodes), dtype=np.float64, count=len(nodes))
+        self.node_x = np.fromiter((self.graph.nodes[node]['x'] for node in nodes), dtype=np.float64, count=len(nodes))
+        node_latlon = np.column_stack((self.node_y, self.node_x))
+
+        self._node_tree = None  # Rebuilt lazily for the new graph by nearest_nodes
+        # Resolved once per graph instead of through get_edge_data for every route
+        self.edge_coords = {}
+        edge_lengths = {}
+        for u, v, data in self.graph.edges(data=True):
+            # Among parallel edges keep the shortest (first on ties), the same edge
+            # ox.convert.to_digraph keeps for route ranking, so polylines follow it
+            length = data.get('length', float('inf'))
+            if (u, v) in edge_lengths and length >= edge_lengths[(u, v)]:
+                continue
+            edge_lengths[(u, v)] = length
+            if 'geometry' in data:
+                # Convert the LineString (lon, lat) points to (lat, lon)
+                self.edge_coords[(u, v)] = np.asarray(data['geometry'].coords)[:, ::-1]
+            else:
+                # Fallback to node coordinates if no geometry
+                self.edge_coords[(u, v)] = node_latlon[[self.node_idx[u], self.node_idx[v]]]
+
+    def nearest_nodes(self, lats, lons):
+        """
+        Return the graph node nearest to each (lat, lon) pair.
+        """
+        # Memoized across jobs by graph cache path and exact coordinates
+        keys = [(self.graph_key, lat, lon) for lat, lon in zip(lats, lons)]
+        nodes = {}
+        with _nearest_node_lock:
+            for key in keys:
+                node = _nearest_node_cache.get(key)
+                # A refetched graph may no longer contain a memoized node
+                if node is not None and node in self.node_idx:
+                    _nearest_node_cache.move_to_end(key)
+                    nodes[key] = node
+
+        missing = [key for key in dict.fromkeys(keys) if key not in nodes]
+        if missing:
+            if self._node_tree is None:
+                # Built once per graph and reused for every lookup on it
+                self._node_tree = BallTree(np.radians(np.column_stack((self.node_y, self.node_x))), metric='haversine')
+
+            _, indices = self._node_tree.query(np.radians([key[1:] for key in missing]), k=1)
+            for key, i in zip(missing, indices[:, 0]):
+                nodes[key] = int(self.node_ids[i])
+
+            if self.graph_key is not None:
+                with _nearest_node_lock:
+                    for key in missing:
+                        _nearest_node_cache[key] = nodes[key]
+                        _nearest_node_cache.move_to_end(key)
+                    while len(_nearest_node_cache) > NEAREST_NODE_CACHE_SIZE:
+                        _nearest_node_cache.popitem(last=False)
+
+        return [nodes[key] for key in keys]
+
+    def compute_routes_start_radius(self):
         if not self.radius_km:
             raise ValueError("Radius is required for local route computation.")
 
         if not self.graph:
             self.fetch_graph_radius()
 
-        start_node = ox.distance.nearest_nodes(self.graph, self.start_location[1], self.start_location[0])
+        start_node = self.nearest_nodes([self.start_location[0]], [self.start_location[1]])[0]
         logger.info("Computing routes from start node...")
-        self.unique_routes = []  # Initialize unique routes list
-        seen_routes = set()  # Track unique routes
+        self.unique_routes = self.enumerate_simple_paths(start_node)
+        logger.info("Found %d unique routes", len(self.unique_routes))
+
+    def enumerate_simple_paths(self, start_node, cutoff=Config.MAX_PATH_LENGTH):
+        """
+        Return every simple path leaving start_node with at most `cutoff` edges.
+        """
+        # One depth-first walk emits each path once; it is split into branches at
+        # depth 2 (start -> first -> second node) and progress is reported per branch
+        adjacency = {node: list(self.graph.successors(node)) for node in self.graph.nodes}
+        routes = []
+        branches = []
+        for first_node in adjacency[start_node]:
+            if first_node == start_node:
+                continue
+            routes.append([start_node, first_node])
+            if cutoff < 2:
+                continue
+            for second_node in adjacency[first_node]:
+                if second_node not in (start_node, first_node):
+                    branches.append((first_node, second_node))
+
         start_time = time.time()
-        total_nodes = len(self.graph.nodes)
-        completed_nodes = 0
+        if not branches:
+            self.update_progress(1, 1, start_time)
+
+        for completed_branches, (first_node, second_node) in enumerate(branches, start=1):
+            path = [start_node, first_node, second_node]
+            visited = set(path)
+            routes.append(list(path))
+            stack = [iter(adjacency[second_node])] if len(path) <= cutoff else []
+
+            while stack:
+                next_node = next(stack[-1], None)
+                if next_node is None:
+                    # All neighbours explored: backtrack
+                    stack.pop()
+                    visited.discard(path.pop())
+                    continue
+                if next_node in visited:
+                    continue
+
+                path.append(next_node)
+                routes.append(list(path))
+                if len(path) <= cutoff:
+                    visited.add(next_node)
+                    stack.append(iter(adjacency[next_node]))
+                else:
+                    path.pop()
 
-        for target_node in self.graph.nodes:
-            if target_node != start_node:
-                try:
-                    routes = list(nx.all_simple_paths(self.graph, source=start_node, target=target_node))  # Added cutoff to limit path length
-                    for route in routes:
-                        route_tuple = tuple(route)  # Convert route to tuple for hashing
-                        if route_tuple not in seen_routes:
-                            self.unique_routes.append(route)
-                            seen_routes.add(route_tuple)
-                except nx.NetworkXNoPath:
-                    pass
-                finally:
-                    completed_nodes += 1
-                    self.update_progress(completed_nodes, total_nodes, start_time)
+            self.update_progress(completed_branches, len(branches), start_time)
 
-        logger.info("Found %d unique routes", len(self.unique_routes))
+        self.flush_progress()
+        return routes
 
-    async def compute_routes_start_end_radius(self):
+    def compute_routes_start_end_radius(self):
         """
-        Compute all unique routes between start and end points using a radius.
+        Compute the max_routes shortest routes between start and end points using a radius.
         """
         if not self.end_location:
             raise ValueError("End location is required to compute routes between start and end points.")
@@ -176,30 +365,41 @@ class RoutePlanner:
         if not self.graph:
             self.fetch_graph_radius()
 
-        start_node = ox.distance.nearest_nodes(self.graph, self.start_location[1], self.start_location[0])
-        end_node = ox.distance.nearest_nodes(self.graph, self.end_location[1], self.end_location[0])
+        start_node, end_node = self.nearest_nodes(
+            [self.start_location[0], self.end_location[0]],
+            [self.start_location[1], self.end_location[1]]
+        )
 
-        logger.info("Finding all possible simple paths between start and end nodes...")
+        logger.info("Finding the %d shortest routes between start and end nodes...", self.max_routes)
         try:
-            start_time = time.time()  # Start timing the route finding
-            all_routes = list(nx.all_simple_paths(self.graph, source=start_node, target=end_node))
-            self.update_progress(1, 1, start_time)  # Update progress once all routes are found
+            self.unique_routes = self.find_shortest_routes(start_node, end_node)
         except nx.NetworkXNoPath:
             logger.info("No path found between start and end nodes.")
             self.unique_routes = []
             return
 
-        logger.info("Found %d possible routes. Removing duplicates...", len(all_routes))
-        seen_routes = set()
-        for route in all_routes:
-            route_set = frozenset(route)
-            if route_set not in seen_routes:
-                self.unique_routes.append(route)
-                seen_routes.add(route_set)
-
         logger.info("%d unique routes found.", len(self.unique_routes))
 
-    async def compute_routes_start_polygon(self, polygon):
+    def find_shortest_routes(self, start_node, end_node):
+        """
+        Return up to max_routes distinct routes between two nodes, shortest first.
+        """
+        start_time = time.time()  # Start timing the route finding
+        # Yen's algorithm on the length-weighted DiGraph, polynomial per route
+        digraph = ox.convert.to_digraph(self.graph, weight="length")
+        routes = []
+        try:
+            for route in islice(nx.shortest_simple_paths(digraph, start_node, end_node, weight="length"), self.max_routes):
+                routes.append(route)
+                self.update_progress(len(routes), self.max_routes, start_time)
+        finally:
+            # Report completion against the routes actually found (1/1 when there is no path)
+            found_routes = len(routes) or 1
+            self.update_progress(found_routes, found_routes, start_time)
+            self.flush_progress()
+        return routes
+
+    def compute_routes_start_polygon(self, polygon):
         """
         Compute all unique routes starting from the given start location within a specified polygon.
         """
@@ -211,34 +411,15 @@ class RoutePlanner:
         if not self.graph:
             raise ValueError("Graph could not be fetched for the given polygon.")
 
-        start_node = ox.distance.nearest_nodes(self.graph, self.start_location[1], self.start_location[0])
+        start_node = self.nearest_nodes([self.start_location[0]], [self.start_location[1]])[0]
 
         logger.info("Computing routes from start node within the polygon...")
-        seen_routes = set()  # Track unique routes
-        start_time = time.time()
-        total_nodes = len(self.graph.nodes)
-        completed_nodes = 1
-
-        for target_node in self.graph.nodes:
-            if target_node != start_node:
-                try:
-                    routes = list(nx.all_simple_paths(self.graph, source=start_node, target=target_node))  # Added cutoff to limit path length
-                    for route in routes:
-                        route_tuple = tuple(route)  # Convert route to tuple for hashing
-                        if route_tuple not in seen_routes:
-                            self.unique_routes.append(route)
-                            seen_routes.add(route_tuple)
-                except nx.NetworkXNoPath:
-                    pass
-                finally:
-                    completed_nodes += 1
-                    self.update_progress(completed_nodes, total_nodes, start_time)
-
+        self.unique_routes = self.enumerate_simple_paths(start_node)
         logger.info("Found %d unique routes", len(self.unique_routes))
 
-    async def compute_routes_start_end_polygon(self, polygon):
+    def compute_routes_start_end_polygon(self, polygon):
         """
-        Compute all unique routes between start and end points within a given polygon.
+        Compute the max_routes shortest routes between start and end points within a given polygon.
         """
         if not self.end_location:
             raise ValueError("End location is required to compute routes between start and end points.")
@@ -248,27 +429,19 @@ class RoutePlanner:
         if not self.graph:
             self.fetch_graph_polygon(polygon)
 
-        start_node = ox.distance.nearest_nodes(self.graph, self.start_location[1], self.start_location[0])
-        end_node = ox.distance.nearest_nodes(self.graph, self.end_location[1], self.end_location[0])
+        start_node, end_node = self.nearest_nodes(
+            [self.start_location[0], self.end_location[0]],
+            [self.start_location[1], self.end_location[1]]
+        )
 
-        logger.info("Finding all possible simple paths between start and end nodes within the polygon...")
+        logger.info("Finding the %d shortest routes between start and end nodes within the polygon...", self.max_routes)
         try:
-            start_time = time.time()  # Start timing the route finding
-            all_routes = list(nx.all_simple_paths(self.graph, source=start_node, target=end_node))
-            self.update_progress(1, 1, start_time)  # Update progress once all routes are found
+            self.unique_routes = self.find_shortest_routes(start_node, end_node)
         except nx.NetworkXNoPath:
             logger.info("No path found between start and end nodes within the polygon.")
             self.unique_routes = []
             return
 
-        logger.info("Found %d possible routes. Removing duplicates...", len(all_routes))
-        seen_routes = set()
-        for route in all_routes:
-            route_set = frozenset(route)
-            if route_set not in seen_routes:
-                self.unique_routes.append(route)
-                seen_routes.add(route_set)
-
         logger.info("%d unique routes found.", len(self.unique_routes))
 
     def filter_routes_by_point(self, middle_points):
@@ -283,16 +456,17 @@ class RoutePlanner:
                 if not isinstance(point, dict) or 'latitude' not in point or 'longitude' not in point:
                     raise ValueError(f"Invalid middle point format: {point}")
 
-            # Find the nearest nodes for all middle points
-            target_nodes = [
-                ox.distance.nearest_nodes(self.graph, point['longitude'], point['latitude'])
-                for point in middle_points
-            ]
+            # Find the nearest nodes for all middle points in one query
+            target_nodes = self.nearest_nodes(
+                [point['latitude'] for point in middle_points],
+                [point['longitude'] for point in middle_points]
+            )
 
-            # Filter routes that pass through all target nodes
+            # Filter routes that pass through all target nodes (one set per route instead of a list scan per target)
+            target_set = set(target_nodes)
             filtered_routes = [
                 route for route in self.unique_routes
-                if all(target_node in route for target_node in target_nodes)
+                if target_set.issubset(route)
             ]
             logger.info("Number of filtered routes: %d", len(filtered_routes))
 
@@ -312,29 +486,14 @@ class RoutePlanner:
 
         route_polylines = []
         for idx, route in enumerate(self.unique_routes):
-            path_coords = []
-            for u, v in zip(route[:-1], route[1:]):
-                # Get edge data including geometry
-                edge_data = self.graph.get_edge_data(u, v)
-                if edge_data and 'geometry' in edge_data[0]:
-                    # Extract all points from the LineString geometry
-                    points = list(edge_data[0]['geometry'].coords)
-                    # Convert to (lat, lon) format and extend path
-                    path_coords.extend([(y, x) for x, y in points])
-                else:
-                    # Fallback to node coordinates if no geometry
-                    path_coords.append((self.graph.nodes[u]['y'], self.graph.nodes[u]['x']))
-                    path_coords.append((self.graph.nodes[v]['y'], self.graph.nodes[v]['x']))
-            
+            path_coords = np.concatenate([self.edge_coords[(u, v)] for u, v in zip(route[:-1], route[1:])])
+
             # Remove duplicate consecutive points
-            cleaned_coords = [path_coords[0]]
-            for coord in path_coords[1:]:
-                if coord != cleaned_coords[-1]:
-                    cleaned_coords.append(coord)
-            
+            keep = np.concatenate(([True], np.any(path_coords[1:] != path_coords[:-1], axis=1)))
+
             route_polylines.append({
                 "route_id": idx + 1,
-                "polyline": cleaned_coords
+                "polyline": path_coords[keep].tolist()
             })
 
         return route_polylines